@@ -591,7 +591,7 @@ def pre_config(
     "--n-jobs",
     type=int,
     default=None,
-    help="number of jobs (optimal value may depend on your VRAM capacity and audio duration per file)",
+    help="number of CPU workers computing f0 and spectrograms (HuBERT and crepe run in the main process, default: all cores, or 1 without a GPU)",
 )
 @click.option(
     "-f/-nf",
@@ -606,12 +606,19 @@ def pre_config(
     type=click.Choice(["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"]),
     default="dio",
 )
+@click.option(
+    "--compile/--no-compile",
+    type=bool,
+    default=False,
+    help="torch.compile HuBERT (CUDA GPUs of compute capability 7.0 or later only)",
+)
 def pre_hubert(
     input_dir: Path,
     config_path: Path,
     n_jobs: bool,
     force_rebuild: bool,
     f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"],
+    compile: bool,
 ) -> None:
     """Preprocessing part 3: hubert
     If the HuBERT model is not found, it will be downloaded automatically."""
@@ -625,6 +632,7 @@ def pre_hubert(
         n_jobs=n_jobs,
         force_rebuild=force_rebuild,
         f0_method=f0_method,
+        compile=compile,
     )
 
 
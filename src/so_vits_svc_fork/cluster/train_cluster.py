@@ -12,9 +12,19 @@ from joblib import Parallel, delayed
 from sklearn.cluster import KMeans, MiniBatchKMeans
 from tqdm_joblib import tqdm_joblib
 
+from ..dataset import get_datapath, load_data
+
 LOG = getLogger(__name__)
 
 
+def _get_datapaths(input_dir: Path) -> list[Path]:
+    return [
+        datapath
+        for datapath in map(get_datapath, input_dir.rglob("*.wav"))
+        if datapath.exists()
+    ]
+
+
 def train_cluster(
     input_dir: Path | str,
     n_clusters: int,
@@ -27,11 +37,8 @@ def train_cluster(
     if not partial_fit:
         LOG.info(f"Loading features from {input_dir}")
         features = []
-        for path in input_dir.rglob("*.data.pt"):
-            with path.open("rb") as f:
-                features.append(
-                    torch.load(f, weights_only=True)["content"].squeeze(0).numpy().T
-                )
+        for path in _get_datapaths(input_dir):
+            features.append(load_data(path)["content"].squeeze(0).numpy().T)
         if not features:
             raise ValueError(f"No features found in {input_dir}")
         features = np.concatenate(features, axis=0).astype(np.float32)
@@ -65,7 +72,7 @@ def train_cluster(
         return x
     else:
         # minibatch partial fit
-        paths = list(input_dir.rglob("*.data.pt"))
+        paths = _get_datapaths(input_dir)
         if len(paths) == 0:
             raise ValueError(f"No features found in {input_dir}")
         LOG.info(f"Found {len(paths)} features in {input_dir}")
@@ -85,13 +92,7 @@ def train_cluster(
                 )
                 features = []
                 for path in paths[i : i + batch_size]:
-                    with path.open("rb") as f:
-                        features.append(
-                            torch.load(f, weights_only=True)["content"]
-                            .squeeze(0)
-                            .numpy()
-                            .T
-                        )
+                    features.append(load_data(path)["content"].squeeze(0).numpy().T)
                 features = np.concatenate(features, axis=0).astype(np.float32)
                 kmeans.partial_fit(features)
         LOG.info(f"Clustering took {t.elapsed:.2f} seconds")
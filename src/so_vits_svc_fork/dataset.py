@@ -1,49 +1,275 @@
 from __future__ import annotations
 
+import shutil
+from logging import getLogger
 from pathlib import Path
 from random import Random
-from typing import Sequence
+from typing import Any, Sequence
 
+import numpy as np
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-from torch.utils.data import Dataset
+from safetensors import safe_open
+from torch.utils.data import BatchSampler, Dataset, Sampler
+from tqdm import tqdm
 
 from .hparams import HParams
+from .utils import INDEX_NAME, load_or_build_index
+
+LOG = getLogger(__name__)
+PACKED_KEYS = ("spec", "mel_spec", "f0", "uv", "content", "audio")
+
+
+def get_datapath(filepath: Path | str) -> Path:
+    """Path of the preprocessed data of `filepath`, preferring `.data.safetensors`
+    over the legacy pickled `.data.pt`."""
+    filepath = Path(filepath)
+    datapath = filepath.parent / (filepath.name + ".data.safetensors")
+    if datapath.exists():
+        return datapath
+    return filepath.parent / (filepath.name + ".data.pt")
+
+
+def _get_datapaths_and_lengths(filepaths: Sequence[str]) -> list[tuple[Path, int]]:
+    # use the cached index of each directory instead of checking every file
+    indices: dict[Path, dict[str, int]] = {}
+    datapaths_lengths = []
+    for filepath in map(Path, filepaths):
+        if filepath.parent not in indices:
+            names, lengths = load_or_build_index(filepath.parent)
+            indices[filepath.parent] = dict(zip(names.tolist(), lengths.tolist()))
+        length = indices[filepath.parent].get(filepath.name, -1)
+        suffix = ".data.safetensors" if length >= 0 else ".data.pt"
+        datapaths_lengths.append((filepath.parent / (filepath.name + suffix), length))
+    return datapaths_lengths
+
+
+def _index_mtime(root: Path) -> float:
+    # the directory itself changes when files are added, removed or replaced
+    mtime = root.stat().st_mtime
+    try:
+        return max(mtime, (root / INDEX_NAME).stat().st_mtime)
+    except FileNotFoundError:
+        return mtime
+
+
+def _crop(key: str, x: Any, start: int, end: int, hop_len: int) -> Any:
+    # crop the last (time) axis of a tensor, ndarray or safetensors slice
+    ndim = x.ndim if hasattr(x, "ndim") else len(x.get_shape())
+    if key == "audio":
+        start, end = start * hop_len, end * hop_len
+    return x[(slice(None),) * (ndim - 1) + (slice(start, end),)]
+
+
+def _crop_data(
+    data: dict[str, torch.Tensor], start: int, end: int, hop_len: int
+) -> dict[str, torch.Tensor]:
+    return {
+        k: v if k == "spk" else _crop(k, v, start, end, hop_len)
+        for k, v in data.items()
+    }
+
+
+def load_data(
+    datapath: Path | str,
+    start: int | None = None,
+    end: int | None = None,
+    hop_len: int = 512,
+) -> dict[str, torch.Tensor]:
+    """Load the preprocessed data, only frames [start, end) if specified.
+
+    For `.data.safetensors`, only the byte ranges of the cropped frames are read."""
+    datapath = Path(datapath)
+    crop = start is not None and end is not None
+    if datapath.suffix != ".safetensors":
+        with datapath.open("rb") as f:
+            data = torch.load(f, weights_only=True, map_location="cpu")
+        return _crop_data(data, start, end, hop_len) if crop else data
+    data = {}
+    with safe_open(datapath, framework="pt", device="cpu") as f:
+        for key in f.keys():
+            if not crop or key == "spk":
+                data[key] = f.get_tensor(key)
+            else:
+                data[key] = _crop(key, f.get_slice(key), start, end, hop_len)
+    return data
+
+
+class PackedData:
+    """Per-key tensors of a whole filelist packed into contiguous binary files.
+
+    Each key is stored in ``{key}.bin`` as the flattened tensors of all utterances
+    laid out back to back, and ``index.npz`` holds the offset and shape of every
+    utterance, so that a sample can be sliced out of a memory map without
+    unpickling anything."""
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        with np.load(self.path / "index.npz") as index:
+            self.paths = index["paths"].tolist()
+            self.spk = index["spk"]
+            self.dtypes = {key: index[f"{key}_dtype"].item() for key in PACKED_KEYS}
+            self.offsets = {key: index[f"{key}_offsets"] for key in PACKED_KEYS}
+            self.shapes = {key: index[f"{key}_shapes"] for key in PACKED_KEYS}
+        self._mmaps: dict[str, np.memmap] = {}
+
+    def __getstate__(self) -> dict[str, Any]:
+        # do not pickle the memory maps (would copy the whole file to workers)
+        state = self.__dict__.copy()
+        state["_mmaps"] = {}
+        return state
+
+    def _mmap(self, key: str) -> np.memmap:
+        if key not in self._mmaps:
+            self._mmaps[key] = np.memmap(
+                self.path / f"{key}.bin", dtype=self.dtypes[key], mode="r"
+            )
+        return self._mmaps[key]
+
+    @property
+    def spec_lens(self) -> np.ndarray:
+        return self.shapes["mel_spec"][:, -1]
+
+    def load(
+        self, index: int, start: int | None, end: int | None, hop_len: int
+    ) -> dict[str, torch.Tensor]:
+        data = {}
+        for key in PACKED_KEYS:
+            offset = int(self.offsets[key][index])
+            shape = tuple(int(x) for x in self.shapes[key][index])
+            x = self._mmap(key)[offset : offset + int(np.prod(shape))].reshape(shape)
+            if start is not None and end is not None:
+                x = _crop(key, x, start, end, hop_len)
+            # copy only the cropped part out of the read-only memory map
+            data[key] = torch.from_numpy(np.array(x))
+        data["spk"] = torch.tensor(self.spk[index]).long()
+        return data
+
+    @classmethod
+    def pack(cls, datapaths: Sequence[Path], path: Path | str) -> PackedData:
+        """Pack `datapaths` into `path`, replacing an existing pack.
+
+        Must be called from a single process only."""
+        path = Path(path)
+        temppath = path.parent / f"{path.name}.tmp"
+        shutil.rmtree(temppath, ignore_errors=True)
+        temppath.mkdir(parents=True)
+        offsets: dict[str, list[int]] = {key: [] for key in PACKED_KEYS}
+        shapes: dict[str, list[tuple[int, ...]]] = {key: [] for key in PACKED_KEYS}
+        dtypes: dict[str, np.dtype[Any]] = {}
+        spks = []
+        files = {key: (temppath / f"{key}.bin").open("wb") for key in PACKED_KEYS}
+        try:
+            for datapath in tqdm(datapaths, desc=f"Packing {path.name}"):
+                data = load_data(datapath)
+                for key in PACKED_KEYS:
+                    x = data[key].numpy()
+                    x = x.astype(dtypes.setdefault(key, x.dtype), copy=False)
+                    offsets[key].append(files[key].tell() // x.itemsize)
+                    shapes[key].append(x.shape)
+                    files[key].write(np.ascontiguousarray(x).tobytes())
+                spks.append(int(data["spk"]))
+        finally:
+            for f in files.values():
+                f.close()
+        index: dict[str, Any] = {
+            "paths": np.array([Path(p).as_posix() for p in datapaths]),
+            "spk": np.array(spks, dtype=np.int64),
+        }
+        for key in PACKED_KEYS:
+            index[f"{key}_dtype"] = np.array(np.dtype(dtypes[key]).str)
+            index[f"{key}_offsets"] = np.array(offsets[key], dtype=np.int64)
+            index[f"{key}_shapes"] = np.array(shapes[key], dtype=np.int64)
+        np.savez(temppath / "index.npz", **index)
+        if path.exists():
+            # a directory cannot be replaced by rename(), move the old pack aside
+            oldpath = path.parent / f"{path.name}.old"
+            shutil.rmtree(oldpath, ignore_errors=True)
+            path.rename(oldpath)
+            shutil.rmtree(oldpath, ignore_errors=True)
+        temppath.rename(path)
+        return cls(path)
 
 
 class TextAudioDataset(Dataset):
     def __init__(self, hps: HParams, is_validation: bool = False):
-        self.datapaths = [
-            Path(x).parent / (Path(x).name + ".data.pt")
-            for x in Path(
-                hps.data.validation_files if is_validation else hps.data.training_files
-            )
-            .read_text("utf-8")
-            .splitlines()
-        ]
+        filelist_path = Path(
+            hps.data.validation_files if is_validation else hps.data.training_files
+        )
+        # lengths are -1 if unknown (.data.pt)
+        datapaths_lengths = _get_datapaths_and_lengths(
+            filelist_path.read_text("utf-8").splitlines()
+        )
         self.hps = hps
         self.random = Random(hps.train.seed)
-        self.random.shuffle(self.datapaths)
+        self.random.shuffle(datapaths_lengths)
+        self.datapaths = [datapath for datapath, _ in datapaths_lengths]
         self.max_spec_len = 800
+        self.packed_path = filelist_path.parent / f"{filelist_path.stem}.packed"
+        self.packed: PackedData | None = None
+        # number of frames of each sample, used to crop before loading
+        self.lengths = np.array(
+            [length for _, length in datapaths_lengths], dtype=np.int64
+        )
+
+    def _is_packed(self) -> bool:
+        index_path = self.packed_path / "index.npz"
+        if not index_path.exists():
+            return False
+        with np.load(index_path) as index:
+            paths = index["paths"].tolist()
+        packed_mtime = index_path.stat().st_mtime
+        # the index of each directory is rebuilt after preprocessing,
+        # so checking it is enough instead of stat-ing every datapath
+        return paths == [p.as_posix() for p in self.datapaths] and all(
+            _index_mtime(d) <= packed_mtime for d in {p.parent for p in self.datapaths}
+        )
+
+    def pack(self) -> None:
+        """Pack the dataset into `packed_path` unless it is already up to date.
+
+        Writes a copy of all the preprocessed data, so call this from a single
+        process only (e.g. `LightningDataModule.prepare_data`), then call
+        `load_packed` from every process. Does nothing if
+        `hps.data.pack_dataset` is false."""
+        if not self.hps.data.get("pack_dataset", True) or self._is_packed():
+            return
+        if self.packed_path.exists():
+            LOG.info(f"{self.packed_path} is outdated, repacking")
+        try:
+            PackedData.pack(self.datapaths, self.packed_path)
+        except Exception as e:
+            LOG.warning(f"Failed to pack dataset, loading files one by one: {e}")
+
+    def load_packed(self) -> None:
+        """Load samples from the pack written by `pack` if it is up to date."""
+        if not self.hps.data.get("pack_dataset", True) or not self._is_packed():
+            return
+        self.packed = PackedData(self.packed_path)
+        self.lengths = self.packed.spec_lens
 
     def __getitem__(self, index: int) -> dict[str, torch.Tensor]:
-        with Path(self.datapaths[index]).open("rb") as f:
-            data = torch.load(f, weights_only=True, map_location="cpu")
+        hop_len = self.hps.data.hop_length
+        spec_len = int(self.lengths[index])
+        if spec_len < 0:
+            # length is unknown for .data.pt, load everything and crop afterwards
+            data = load_data(self.datapaths[index])
+            spec_len = data["mel_spec"].shape[1]
+        else:
+            data = None
 
         # cut long data randomly
-        spec_len = data["mel_spec"].shape[1]
-        hop_len = self.hps.data.hop_length
+        start, end = None, None
         if spec_len > self.max_spec_len:
             start = self.random.randint(0, spec_len - self.max_spec_len)
             end = start + self.max_spec_len - 10
-            for key in data.keys():
-                if key == "audio":
-                    data[key] = data[key][:, start * hop_len : end * hop_len]
-                elif key == "spk":
-                    continue
-                else:
-                    data[key] = data[key][..., start:end]
+
+        if self.packed is not None:
+            return self.packed.load(index, start, end, hop_len)
+        if data is None:
+            data = load_data(self.datapaths[index], start, end, hop_len)
+        elif start is not None and end is not None:
+            data = _crop_data(data, start, end, hop_len)
         torch.cuda.empty_cache()
         return data
 
@@ -51,14 +277,58 @@ class TextAudioDataset(Dataset):
         return len(self.datapaths)
 
 
+class LengthBucketSampler(BatchSampler):
+    """Batch sampler which puts samples of similar lengths into the same batch
+    to reduce padding.
+
+    Indices drawn from `sampler` are gathered into pools of
+    `batch_size * bucket_mult`, each pool is sorted by `lengths` and split into
+    batches, and the batches of a pool are yielded in random order."""
+
+    def __init__(
+        self,
+        sampler: Sampler[int] | Sequence[int],
+        batch_size: int,
+        drop_last: bool,
+        lengths: Sequence[int],
+        bucket_mult: int = 50,
+        seed: int = 0,
+    ):
+        super().__init__(sampler, batch_size, drop_last)
+        self.lengths = lengths
+        self.bucket_mult = bucket_mult
+        self.random = Random(seed)
+
+    def _batches(self, pool: list[int]) -> list[list[int]]:
+        pool = sorted(pool, key=lambda i: self.lengths[i], reverse=True)
+        batches = [
+            pool[i : i + self.batch_size] for i in range(0, len(pool), self.batch_size)
+        ]
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        self.random.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        pool_size = self.batch_size * self.bucket_mult
+        pool = []
+        for idx in self.sampler:
+            pool.append(idx)
+            if len(pool) == pool_size:
+                yield from self._batches(pool)
+                pool = []
+        if pool:
+            yield from self._batches(pool)
+
+
 def _pad_stack(array: Sequence[torch.Tensor]) -> torch.Tensor:
-    max_idx = torch.argmax(torch.tensor([x_.shape[-1] for x_ in array]))
-    max_x = array[max_idx]
-    x_padded = [
-        F.pad(x_, (0, max_x.shape[-1] - x_.shape[-1]), mode="constant", value=0)
-        for x_ in array
-    ]
-    return torch.stack(x_padded)
+    # same as torch.nested.nested_tensor(array).to_padded_tensor(0.0),
+    # but without copying everything into the nested buffer first
+    max_len = max(x_.shape[-1] for x_ in array)
+    x_padded = array[0].new_zeros((len(array), *array[0].shape[:-1], max_len))
+    for i, x_ in enumerate(array):
+        x_padded[i, ..., : x_.shape[-1]] = x_
+    return x_padded
 
 
 class TextAudioCollate(nn.Module):
@@ -71,9 +341,9 @@ class TextAudioCollate(nn.Module):
         results = {}
         for key in batch[0].keys():
             if key not in ["spk"]:
-                results[key] = _pad_stack([b[key] for b in batch]).cpu()
+                results[key] = _pad_stack([b[key] for b in batch])
             else:
-                results[key] = torch.tensor([[b[key]] for b in batch]).cpu()
+                results[key] = torch.stack([b[key] for b in batch]).view(-1, 1)
 
         return (
             results["content"],
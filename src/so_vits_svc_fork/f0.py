@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from logging import getLogger
-from typing import Any, Literal
+from typing import Any, Literal, Sequence
 
 import numpy as np
 import torch
@@ -156,9 +156,10 @@ def compute_f0_crepe(
     p_len: None | int = None,
     sampling_rate: int = 44100,
     hop_length: int = 512,
-    device: str | torch.device = get_optimal_device(),
+    device: str | torch.device | None = None,
     model: Literal["full", "tiny"] = "full",
 ):
+    device = device or get_optimal_device()
     audio = torch.from_numpy(wav_numpy).to(device, copy=True)
     audio = torch.unsqueeze(audio, dim=0)
 
@@ -185,6 +186,52 @@ def compute_f0_crepe(
     return f0
 
 
+def compute_f0_crepe_batch(
+    wav_numpys: Sequence[ndarray[Any, dtype[float32]]],
+    sampling_rate: int = 44100,
+    hop_length: int = 512,
+    device: str | torch.device | None = None,
+    model: Literal["full", "tiny"] = "full",
+    batch_size: int | None = None,
+) -> list[ndarray[Any, dtype[float32]]]:
+    """Batched version of `compute_f0_crepe` for many audios.
+
+    The frames of all audios are passed through CREPE together, `batch_size`
+    frames at a time, so that short audios do not underutilize the GPU.
+    Decoding is done per audio."""
+    device = device or get_optimal_device()
+    batch_size = batch_size or hop_length * 2
+    frames = []
+    for wav_numpy in wav_numpys:
+        audio = torch.from_numpy(wav_numpy).float().unsqueeze(0)
+        # a single chunk of all frames of this audio
+        frames.append(
+            next(
+                torchcrepe.preprocess(
+                    audio, sampling_rate, hop_length, device=device, pad=True
+                )
+            )
+        )
+    n_frames = [len(x) for x in frames]
+    with torch.inference_mode():
+        probabilities = torch.cat(
+            [
+                torchcrepe.infer(chunk, model)
+                for chunk in torch.cat(frames).split(batch_size)
+            ]
+        )
+        f0s = []
+        for wav_numpy, probabilities_ in zip(wav_numpys, probabilities.split(n_frames)):
+            pitch: Tensor = torchcrepe.postprocess(
+                probabilities_.reshape(1, -1, torchcrepe.PITCH_BINS).transpose(1, 2),
+                f0_min,
+                f0_max,
+            )
+            f0 = pitch.squeeze(0).cpu().float().numpy()
+            f0s.append(_resize_f0(f0, wav_numpy.shape[0] // hop_length))
+    return f0s
+
+
 def compute_f0(
     wav_numpy: ndarray[Any, dtype[float32]],
     p_len: None | int = None,
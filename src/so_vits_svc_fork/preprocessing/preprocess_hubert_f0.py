@@ -1,119 +1,175 @@
 from __future__ import annotations
 
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from functools import partial
+from itertools import islice
 from logging import getLogger
 from pathlib import Path
-from random import shuffle
-from typing import Iterable, Literal
+from typing import Any, Iterable, Literal, Sequence
 
-import librosa
-import numpy as np
+import soundfile
 import torch
 import torchaudio
-from joblib import Parallel, cpu_count, delayed
+from joblib import cpu_count, effective_n_jobs
+from numpy import ndarray
+from safetensors.torch import save_file
 from tqdm import tqdm
-from transformers import HubertModel
 
 import so_vits_svc_fork.f0
 from so_vits_svc_fork import utils
 
+from ..dataset import get_datapath
 from ..hparams import HParams
 from ..modules.mel_processing import spec_to_mel_torch, spectrogram_torch
-from ..utils import get_optimal_device, get_total_gpu_memory
+from ..utils import get_optimal_device
 from .preprocess_utils import check_hubert_min_duration
 
 LOG = getLogger(__name__)
-HUBERT_MEMORY = 2900
-HUBERT_MEMORY_CREPE = 3900
+GPU_F0_METHODS = {"crepe": "full", "crepe-tiny": "tiny"}
+HUBERT_BATCH_SIZE = 8
+HUBERT_BATCH_DURATION = 60.0
 
 
-def _process_one(
+def _prepare_one(
     *,
     filepath: Path,
-    content_model: HubertModel,
-    device: torch.device | str = get_optimal_device(),
     f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
     force_rebuild: bool = False,
     hps: HParams,
-):
-    audio, sr = librosa.load(filepath, sr=hps.data.sampling_rate, mono=True)
+) -> dict[str, Any] | None:
+    """Everything but HuBERT, run on the CPU workers."""
+    # also skip files preprocessed in the legacy .data.pt format
+    if not force_rebuild and get_datapath(filepath).exists():
+        return None
 
+    # soundfile is much faster than librosa.load and does not resample
+    # if the file is already at the target sampling rate (after pre-resample)
+    wav, sr = soundfile.read(str(filepath), dtype="float32", always_2d=True)
+    audio_orig = torch.from_numpy(wav.T).mean(dim=0, keepdim=True)
+    if sr != hps.data.sampling_rate:
+        audio_orig = torchaudio.functional.resample(
+            audio_orig, sr, hps.data.sampling_rate
+        )
+        sr = hps.data.sampling_rate
+    audio = audio_orig[0].numpy()
     if not check_hubert_min_duration(audio, sr):
         LOG.info(f"Skip {filepath} because it is too short.")
-        return
-
-    data_path = filepath.parent / (filepath.name + ".data.pt")
-    if data_path.exists() and not force_rebuild:
-        return
-
-    # Compute f0
-    f0 = so_vits_svc_fork.f0.compute_f0(
-        audio, sampling_rate=sr, hop_length=hps.data.hop_length, method=f0_method
-    )
-    f0, uv = so_vits_svc_fork.f0.interpolate_f0(f0)
-    f0 = torch.from_numpy(f0).float()
-    uv = torch.from_numpy(uv).float()
-
-    # Compute HuBERT content
-    audio = torch.from_numpy(audio).float().to(device)
-    c = utils.get_content(
-        content_model,
-        audio,
-        device,
-        sr=sr,
-        legacy_final_proj=hps.data.get("contentvec_final_proj", True),
-    )
-    c = utils.repeat_expand_2d(c.squeeze(0), f0.shape[0])
-    torch.cuda.empty_cache()
+        return None
 
     # Compute spectrogram
-    audio, sr = torchaudio.load(filepath)
-    spec = spectrogram_torch(audio, hps).squeeze(0)
+    spec = spectrogram_torch(audio_orig, hps).squeeze(0)
     mel_spec = spec_to_mel_torch(spec, hps)
-    torch.cuda.empty_cache()
-
-    # fix lengths
-    lmin = min(spec.shape[1], mel_spec.shape[1], f0.shape[0], uv.shape[0], c.shape[1])
-    spec, mel_spec, f0, uv, c = (
-        spec[:, :lmin],
-        mel_spec[:, :lmin],
-        f0[:lmin],
-        uv[:lmin],
-        c[:, :lmin],
-    )
 
     # get speaker id
     spk_name = filepath.parent.name
     spk = hps.spk.__dict__[spk_name]
     spk = torch.tensor(spk).long()
-    assert (
-        spec.shape[1] == mel_spec.shape[1] == f0.shape[0] == uv.shape[0] == c.shape[1]
-    ), (spec.shape, mel_spec.shape, f0.shape, uv.shape, c.shape)
     data = {
+        "filepath": filepath,
+        # input of HuBERT
+        "hubert_audio": audio_orig[0],
         "spec": spec,
         "mel_spec": mel_spec,
-        "f0": f0,
-        "uv": uv,
-        "content": c,
-        "audio": audio,
+        "audio": audio_orig,
         "spk": spk,
     }
-    data = {k: v.cpu() for k, v in data.items()}
-    with data_path.open("wb") as f:
-        torch.save(data, f)
 
+    # Compute f0 (CREPE is batched on the main process)
+    if f0_method not in GPU_F0_METHODS:
+        f0 = so_vits_svc_fork.f0.compute_f0(
+            audio, sampling_rate=sr, hop_length=hps.data.hop_length, method=f0_method
+        )
+        _set_f0(data, f0)
+    return data
 
-def _process_batch(filepaths: Iterable[Path], pbar_position: int, **kwargs):
-    hps = kwargs["hps"]
-    content_model = utils.get_hubert_model(
-        get_optimal_device(), hps.data.get("contentvec_final_proj", True)
-    )
 
-    for filepath in tqdm(filepaths, position=pbar_position):
-        _process_one(
-            content_model=content_model,
-            filepath=filepath,
-            **kwargs,
+def _set_f0(data: dict[str, Any], f0: ndarray) -> None:
+    f0, uv = so_vits_svc_fork.f0.interpolate_f0(f0)
+    data["f0"] = torch.from_numpy(f0).float()
+    data["uv"] = torch.from_numpy(uv).float()
+
+
+def _prepare_many(
+    filepaths: Sequence[Path], **kwargs: Any
+) -> tuple[int, list[dict[str, Any]]]:
+    return len(filepaths), [
+        data
+        for data in (
+            _prepare_one(filepath=filepath, **kwargs) for filepath in filepaths
         )
+        if data is not None
+    ]
+
+
+def _prepare_in_background(
+    batches: Iterable[Sequence[Path]], n_jobs: int, **kwargs: Any
+) -> Iterable[tuple[int, list[dict[str, Any]]]]:
+    """Run `_prepare_many` on `n_jobs` worker processes, yielding the results
+    in the order they finish.
+
+    At most `2 * n_jobs` batches are in flight (running or finished but not yet
+    consumed), so that prepared batches do not pile up in memory when the main
+    process is slower than the workers."""
+    batches = iter(batches)
+    with ProcessPoolExecutor(n_jobs) as executor:
+        pending: set[Future[tuple[int, list[dict[str, Any]]]]] = set()
+        while True:
+            for batch in islice(batches, 2 * n_jobs - len(pending)):
+                pending.add(executor.submit(_prepare_many, batch, **kwargs))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def _save_one(data: dict[str, Any], c: torch.Tensor) -> Path:
+    """Run on the main process after HuBERT. Returns the path written."""
+    filepath = data.pop("filepath")
+    data.pop("hubert_audio")
+    data_path = filepath.parent / (filepath.name + ".data.safetensors")
+    spec, mel_spec, f0, uv = data["spec"], data["mel_spec"], data["f0"], data["uv"]
+    c = utils.repeat_expand_2d(c.squeeze(0), f0.shape[0])
+
+    # fix lengths
+    lmin = min(spec.shape[1], mel_spec.shape[1], f0.shape[0], uv.shape[0], c.shape[1])
+    data.update(
+        spec=spec[:, :lmin],
+        mel_spec=mel_spec[:, :lmin],
+        f0=f0[:lmin],
+        uv=uv[:lmin],
+        content=c[:, :lmin],
+    )
+    data = {k: v.cpu().contiguous() for k, v in data.items()}
+    save_file(data, data_path)
+    # superseded by .data.safetensors (when rebuilt with force_rebuild)
+    (filepath.parent / (filepath.name + ".data.pt")).unlink(missing_ok=True)
+    return data_path
+
+
+def _batch_by_duration(
+    filepaths: Iterable[Path],
+    batch_size: int = HUBERT_BATCH_SIZE,
+    batch_duration: float = HUBERT_BATCH_DURATION,
+) -> Iterable[list[Path]]:
+    """Group files of similar durations so that HuBERT pads as little as possible,
+    limiting the padded duration of a batch to `batch_duration` seconds."""
+    durations = {
+        filepath: soundfile.info(str(filepath)).duration for filepath in filepaths
+    }
+    batch: list[Path] = []
+    for filepath in sorted(durations, key=durations.__getitem__):
+        # sorted, so the current file is the longest in the batch
+        if batch and (
+            len(batch) >= batch_size
+            or (len(batch) + 1) * durations[filepath] > batch_duration
+        ):
+            yield batch
+            batch = []
+        batch.append(filepath)
+    if batch:
+        yield batch
 
 
 def preprocess_hubert_f0(
@@ -122,38 +178,83 @@ def preprocess_hubert_f0(
     n_jobs: int | None = None,
     f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
     force_rebuild: bool = False,
+    compile: bool = False,
 ):
+    """Compute f0, spectrogram and HuBERT content of all wav files in `input_dir`.
+
+    `n_jobs` CPU workers load the audio and compute f0 and spectrograms, while
+    the main process runs a single HuBERT model (and CREPE, if `f0_method` is
+    crepe or crepe-tiny) on batches of files of similar durations as soon as
+    the workers finish them. If `compile` is True, HuBERT is compiled with
+    torch.compile, falling back to eager mode if compiling fails."""
     input_dir = Path(input_dir)
     config_path = Path(config_path)
     hps = utils.get_hparams(config_path)
+    device = get_optimal_device()
     if n_jobs is None:
-        # add cpu_count() to avoid SIGKILL
-        memory = get_total_gpu_memory("total")
-        n_jobs = min(
-            max(
-                (
-                    memory
-                    // (HUBERT_MEMORY_CREPE if f0_method == "crepe" else HUBERT_MEMORY)
-                    if memory is not None
-                    else 1
-                ),
-                1,
-            ),
-            cpu_count(),
-        )
-        LOG.info(f"n_jobs automatically set to {n_jobs}, memory: {memory} MiB")
-
-    filepaths = list(input_dir.rglob("*.wav"))
-    n_jobs = min(len(filepaths) // 16 + 1, n_jobs)
-    shuffle(filepaths)
-    filepath_chunks = np.array_split(filepaths, n_jobs)
-    Parallel(n_jobs=n_jobs)(
-        delayed(_process_batch)(
-            filepaths=chunk,
-            pbar_position=pbar_position,
+        # without a GPU, HuBERT in the main process needs the CPU cores as well
+        n_jobs = 1 if device.type == "cpu" else cpu_count()
+    n_jobs = effective_n_jobs(n_jobs)
+
+    content_model = utils.get_hubert_model(
+        device, hps.data.get("contentvec_final_proj", True), compile=compile
+    )
+    dirs = [Path(dirpath) for dirpath, _, _ in os.walk(input_dir)]
+    filepaths = [
+        dir_ / name
+        for dir_ in dirs
+        for name in utils.load_or_build_index(dir_)[0].tolist()
+    ]
+    batches = list(_batch_by_duration(filepaths))
+    written_dirs: set[Path] = set()
+    with tqdm(total=len(filepaths)) as pbar:
+        for n_files, prepared in _prepare_in_background(
+            batches,
+            n_jobs,
             f0_method=f0_method,
             force_rebuild=force_rebuild,
             hps=hps,
-        )
-        for (pbar_position, chunk) in enumerate(filepath_chunks)
-    )
+        ):
+            if prepared:
+                if f0_method in GPU_F0_METHODS:
+                    f0s = so_vits_svc_fork.f0.compute_f0_crepe_batch(
+                        [data["hubert_audio"].numpy() for data in prepared],
+                        sampling_rate=hps.data.sampling_rate,
+                        hop_length=hps.data.hop_length,
+                        device=device,
+                        model=GPU_F0_METHODS[f0_method],
+                    )
+                    for data, f0 in zip(prepared, f0s):
+                        _set_f0(data, f0)
+
+                # Compute HuBERT content of all files at once
+                get_content_batch = partial(
+                    utils.get_content_batch,
+                    audios=[data["hubert_audio"] for data in prepared],
+                    device=device,
+                    sr=hps.data.sampling_rate,
+                    legacy_final_proj=hps.data.get("contentvec_final_proj", True),
+                    mixed_precision=True,
+                )
+                try:
+                    cs = get_content_batch(content_model)
+                except Exception as e:
+                    if not compile:
+                        raise
+                    # compiling happens lazily on the first call
+                    LOG.warning(f"torch.compile failed, running HuBERT eagerly: {e}")
+                    compile = False
+                    content_model = utils.get_hubert_model(
+                        device, hps.data.get("contentvec_final_proj", True)
+                    )
+                    cs = get_content_batch(content_model)
+                for data, c in zip(prepared, cs):
+                    written_dirs.add(_save_one(data, c).parent)
+                torch.cuda.empty_cache()
+            pbar.update(n_files)
+
+    # data files may have been overwritten in place, which does not update the
+    # modification time of the directories. Directories where nothing was
+    # written keep their index, so that the packed dataset stays up to date
+    for dir_ in written_dirs:
+        utils.load_or_build_index(dir_, rebuild=True)
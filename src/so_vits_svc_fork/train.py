@@ -16,7 +16,7 @@ from lightning.pytorch.strategies.ddp import DDPStrategy
 from lightning.pytorch.tuner import Tuner
 from torch.cuda.amp import autocast
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, SequentialSampler
 from torch.utils.tensorboard.writer import SummaryWriter
 
 import so_vits_svc_fork.f0
@@ -24,7 +24,7 @@ import so_vits_svc_fork.modules.commons as commons
 import so_vits_svc_fork.utils
 
 from . import utils
-from .dataset import TextAudioCollate, TextAudioDataset
+from .dataset import LengthBucketSampler, TextAudioCollate, TextAudioDataset
 from .logger import is_notebook
 from .modules.descriminators import MultiPeriodDiscriminator
 from .modules.losses import discriminator_loss, feature_loss, generator_loss, kl_loss
@@ -50,13 +50,34 @@ class VCDataModule(pl.LightningDataModule):
         self.train_dataset = TextAudioDataset(self.__hparams, is_validation=False)
         self.val_dataset = TextAudioDataset(self.__hparams, is_validation=True)
 
+    def prepare_data(self):
+        # called only once per node, before setup() on every process
+        self.train_dataset.pack()
+        self.val_dataset.pack()
+
+    def setup(self, stage: str):
+        self.train_dataset.load_packed()
+        self.val_dataset.load_packed()
+
     def train_dataloader(self):
+        # samples longer than max_spec_len are cropped, so they are of the same length
+        lengths = self.train_dataset.lengths.clip(
+            max=self.train_dataset.max_spec_len
+        ).tolist()
         return DataLoader(
             self.train_dataset,
             num_workers=min(cpu_count(), self.__hparams.train.get("num_workers", 8)),
-            batch_size=self.batch_size,
+            batch_sampler=LengthBucketSampler(
+                SequentialSampler(self.train_dataset),
+                self.batch_size,
+                drop_last=False,
+                lengths=lengths,
+                seed=self.__hparams.train.seed,
+            ),
             collate_fn=self.collate_fn,
             persistent_workers=True,
+            # Lightning copies pinned batches to the GPU with non_blocking=True
+            pin_memory=torch.cuda.is_available(),
         )
 
     def val_dataloader(self):
@@ -64,6 +85,7 @@ class VCDataModule(pl.LightningDataModule):
             self.val_dataset,
             batch_size=1,
             collate_fn=self.collate_fn,
+            pin_memory=torch.cuda.is_available(),
         )
 
 
@@ -283,6 +305,7 @@ class VitsLightning(pl.LightningModule):
         current_epoch = self.current_epoch + adjust
         total_batch_idx = self.total_batch_idx - 1 + adjust
 
+        # written on a background thread, in order
         utils.save_checkpoint(
             self.net_g,
             self.optim_g,
@@ -290,21 +313,26 @@ class VitsLightning(pl.LightningModule):
             current_epoch,
             Path(self.hparams.model_dir)
             / f"G_{total_batch_idx if self.hparams.train.get('ckpt_name_by_step', False) else current_epoch}.pth",
+            background=True,
         )
-        utils.save_checkpoint(
+        future = utils.save_checkpoint(
             self.net_d,
             self.optim_d,
             self.learning_rate,
             current_epoch,
             Path(self.hparams.model_dir)
             / f"D_{total_batch_idx if self.hparams.train.get('ckpt_name_by_step', False) else current_epoch}.pth",
+            background=True,
         )
         keep_ckpts = self.hparams.train.get("keep_ckpts", 0)
         if keep_ckpts > 0:
-            utils.clean_checkpoints(
-                path_to_models=self.hparams.model_dir,
-                n_ckpts_to_keep=keep_ckpts,
-                sort_by_time=True,
+            # clean after both checkpoints have been written
+            future.add_done_callback(
+                lambda _: utils.clean_checkpoints(
+                    path_to_models=self.hparams.model_dir,
+                    n_ckpts_to_keep=keep_ckpts,
+                    sort_by_time=True,
+                )
             )
 
     def set_current_epoch(self, epoch: int):
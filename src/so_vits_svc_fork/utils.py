@@ -1,17 +1,18 @@
 from __future__ import annotations
 
+import contextlib
 import json
 import os
 import re
 import subprocess
 import warnings
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from itertools import groupby
 from logging import getLogger
 from pathlib import Path
 from typing import Any, Literal, Sequence
 
-import matplotlib
-import matplotlib.pylab as plt
 import numpy as np
 import requests
 import torch
@@ -19,7 +20,10 @@ import torch.backends.mps
 import torch.nn as nn
 import torchaudio
 from cm_time import timer
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from numpy import ndarray
+from safetensors import safe_open
 from tqdm import tqdm
 from transformers import HubertModel
 
@@ -28,6 +32,7 @@ from so_vits_svc_fork.hparams import HParams
 LOG = getLogger(__name__)
 HUBERT_SAMPLING_RATE = 16000
 IS_COLAB = os.getenv("COLAB_RELEASE_TAG", False)
+INDEX_NAME = ".index.npz"
 
 
 def get_optimal_device(index: int = 0) -> torch.device:
@@ -47,15 +52,33 @@ def get_optimal_device(index: int = 0) -> torch.device:
     return torch.device("cpu")
 
 
+def _download_range(
+    url: str, filepath: Path, start: int, end: int, chunk_size: int, pbar: Any
+) -> None:
+    resp = requests.get(url, headers={"Range": f"bytes={start}-{end - 1}"}, stream=True)
+    if resp.status_code != 206:
+        raise RuntimeError(f"Range request to {url} failed: {resp.status_code}")
+    with filepath.open("r+b") as f:
+        f.seek(start)
+        for data in resp.iter_content(chunk_size=chunk_size):
+            size = f.write(data)
+            pbar.update(size)
+
+
 def download_file(
     url: str,
     filepath: Path | str,
-    chunk_size: int = 64 * 1024,
+    chunk_size: int = 1024 * 1024,
     tqdm_cls: type = tqdm,
     skip_if_exists: bool = False,
     overwrite: bool = False,
+    n_connections: int = 8,
     **tqdm_kwargs: Any,
 ):
+    """Download `url` to `filepath`.
+
+    If the server supports range requests, the file is split into `n_connections`
+    parts which are downloaded in parallel."""
     if skip_if_exists is True and overwrite is True:
         raise ValueError("skip_if_exists and overwrite cannot be both True")
     filepath = Path(filepath)
@@ -69,8 +92,9 @@ def download_file(
         else:
             raise FileExistsError(f"{filepath} already exists")
     temppath.unlink(missing_ok=True)
-    resp = requests.get(url, stream=True)
-    total = int(resp.headers.get("content-length", 0))
+    # follow redirects once so that the parts are requested from the final url
+    head = requests.head(url, allow_redirects=True)
+    total = int(head.headers.get("content-length", 0))
     kwargs = dict(
         total=total,
         unit="iB",
@@ -79,10 +103,37 @@ def download_file(
         desc=f"Downloading {filepath.name}",
     )
     kwargs.update(tqdm_kwargs)
-    with temppath.open("wb") as f, tqdm_cls(**kwargs) as pbar:
-        for data in resp.iter_content(chunk_size=chunk_size):
-            size = f.write(data)
-            pbar.update(size)
+    with tqdm_cls(**kwargs) as pbar:
+        if (
+            n_connections > 1
+            and total > chunk_size * n_connections
+            and head.headers.get("accept-ranges") == "bytes"
+        ):
+            with temppath.open("wb") as f:
+                f.truncate(total)
+            bounds = [total * i // n_connections for i in range(n_connections + 1)]
+            with ThreadPoolExecutor(n_connections) as executor:
+                futures = [
+                    executor.submit(
+                        _download_range,
+                        head.url,
+                        temppath,
+                        start,
+                        end,
+                        chunk_size,
+                        pbar,
+                    )
+                    for start, end in zip(bounds[:-1], bounds[1:])
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            resp = requests.get(url, stream=True)
+            pbar.total = int(resp.headers.get("content-length", total))
+            with temppath.open("wb") as f:
+                for data in resp.iter_content(chunk_size=chunk_size):
+                    size = f.write(data)
+                    pbar.update(size)
     temppath.rename(filepath)
 
 
@@ -190,7 +241,7 @@ def remove_weight_norm_if_exists(module, name: str = "weight"):
 
 
 def get_hubert_model(
-    device: str | torch.device, final_proj: bool = True
+    device: str | torch.device, final_proj: bool = True, compile: bool = False
 ) -> HubertModel:
     if final_proj:
         model = HubertModelWithFinalProj.from_pretrained("lengyue233/content-vec-best")
@@ -201,7 +252,70 @@ def get_hubert_model(
         if isinstance(m, (nn.Conv2d, nn.Conv1d)):
             remove_weight_norm_if_exists(m)
 
-    return model.to(device)
+    model = model.to(device)
+    if compile:
+        device = torch.device(device)
+        if (
+            # nn.Module.compile was added in torch 2.2
+            not hasattr(nn.Module, "compile")
+            or device.type != "cuda"
+            or os.name == "nt"
+            or torch.cuda.get_device_capability(device) < (7, 0)
+        ):
+            # triton only supports CUDA GPUs of compute capability 7.0 or later
+            # and is not available on Windows
+            LOG.warning("torch.compile is not supported, running HuBERT eagerly")
+        else:
+            # compile in place the submodules used by both get_content and
+            # get_content_batch. Lengths of audios differ every call,
+            # so avoid recompiling for each shape
+            for module in (
+                model.feature_extractor,
+                model.feature_projection,
+                model.encoder,
+            ):
+                module.compile(dynamic=True)
+    return model
+
+
+def _hubert_autocast(
+    device: torch.device | str, enabled: bool
+) -> contextlib.AbstractContextManager[Any]:
+    device = torch.device(device)
+    # torch.autocast raises for some device types (e.g. mps) even if disabled
+    if not enabled or device.type != "cuda":
+        return contextlib.nullcontext()
+    # bfloat16 is safer against overflow, but only has tensor core support
+    # on Ampere or later (is_bf16_supported() is also True if emulated)
+    if torch.cuda.get_device_capability(device)[0] >= 8:
+        return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+    return torch.autocast(device_type="cuda", dtype=torch.float16)
+
+
+def _get_content(
+    cmodel: HubertModel,
+    audio: torch.Tensor,
+    legacy_final_proj: bool = False,
+    mixed_precision: bool = False,
+) -> torch.Tensor:
+    with _hubert_autocast(audio.device, mixed_precision):
+        if legacy_final_proj:
+            warnings.warn("legacy_final_proj is deprecated")
+            if not hasattr(cmodel, "final_proj"):
+                raise ValueError("HubertModel does not have final_proj")
+            c = cmodel(audio, output_hidden_states=True)["hidden_states"][9]
+            c = cmodel.final_proj(c)
+        else:
+            c = cmodel(audio)["last_hidden_state"]
+    return c.transpose(1, 2).float()
+
+
+@lru_cache
+def _get_resampler(
+    orig_freq: int, new_freq: int, device: torch.device
+) -> torchaudio.transforms.Resample:
+    # the resampling kernel is computed only once per (orig_freq, new_freq, device)
+    return torchaudio.transforms.Resample(orig_freq, new_freq).to(device)
 
 
 def get_content(
@@ -210,26 +324,17 @@ def get_content(
     device: torch.device | str,
     sr: int,
     legacy_final_proj: bool = False,
+    mixed_precision: bool = False,
 ) -> torch.Tensor:
-    audio = torch.as_tensor(audio)
+    audio = torch.as_tensor(audio).to(device, non_blocking=True)
     if sr != HUBERT_SAMPLING_RATE:
-        audio = (
-            torchaudio.transforms.Resample(sr, HUBERT_SAMPLING_RATE)
-            .to(audio.device)(audio)
-            .to(device)
-        )
+        audio = _get_resampler(sr, HUBERT_SAMPLING_RATE, audio.device)(audio)
     if audio.ndim == 1:
         audio = audio.unsqueeze(0)
-    with torch.no_grad(), timer() as t:
-        if legacy_final_proj:
-            warnings.warn("legacy_final_proj is deprecated")
-            if not hasattr(cmodel, "final_proj"):
-                raise ValueError("HubertModel does not have final_proj")
-            c = cmodel(audio, output_hidden_states=True)["hidden_states"][9]
-            c = cmodel.final_proj(c)
-        else:
-            c = cmodel(audio)["last_hidden_state"]
-        c = c.transpose(1, 2)
+    with torch.inference_mode(), timer() as t:
+        c = _get_content(
+            cmodel, audio, legacy_final_proj, mixed_precision=mixed_precision
+        )
     wav_len = audio.shape[-1] / HUBERT_SAMPLING_RATE
     LOG.info(
         f"HuBERT inference time  : {t.elapsed:.3f}s, RTF: {t.elapsed / wav_len:.3f}"
@@ -237,33 +342,92 @@ def get_content(
     return c
 
 
+def get_content_batch(
+    cmodel: HubertModel,
+    audios: Sequence[torch.Tensor | ndarray[Any, Any]],
+    device: torch.device | str,
+    sr: int,
+    legacy_final_proj: bool = False,
+    mixed_precision: bool = False,
+) -> list[torch.Tensor]:
+    """Batched version of `get_content` for 1D audios of different lengths.
+
+    The convolutional feature extractor normalizes over time (GroupNorm), so it is
+    run on each audio separately. Only the extracted features are zero-padded and
+    batched through the transformer encoder, with the padding masked out.
+    Returns the same content as `get_content` for each audio, of shape (1, C, T)."""
+    if legacy_final_proj:
+        warnings.warn("legacy_final_proj is deprecated")
+        if not hasattr(cmodel, "final_proj"):
+            raise ValueError("HubertModel does not have final_proj")
+    audios = [torch.as_tensor(audio).to(device, non_blocking=True) for audio in audios]
+    if sr != HUBERT_SAMPLING_RATE:
+        resampler = _get_resampler(sr, HUBERT_SAMPLING_RATE, audios[0].device)
+        audios = [resampler(audio) for audio in audios]
+    with torch.inference_mode(), timer() as t, _hubert_autocast(
+        audios[0].device, mixed_precision
+    ):
+        # (T_i, C) for each audio
+        features = [
+            cmodel.feature_extractor(audio.reshape(1, -1))[0].T for audio in audios
+        ]
+        lengths = [feature.shape[0] for feature in features]
+        hidden_states = cmodel.feature_projection(
+            torch.nn.utils.rnn.pad_sequence(features, batch_first=True)
+        )
+        attention_mask = None
+        if min(lengths) < max(lengths):
+            # build the mask on the device directly, no mask if nothing is padded
+            attention_mask = (
+                torch.arange(max(lengths), device=hidden_states.device)[None, :]
+                < torch.tensor(lengths, device=hidden_states.device)[:, None]
+            )
+        out = cmodel.encoder(
+            hidden_states,
+            attention_mask=attention_mask,
+            output_hidden_states=legacy_final_proj,
+        )
+        if legacy_final_proj:
+            c = cmodel.final_proj(out.hidden_states[9])
+        else:
+            c = out.last_hidden_state
+        c = c.transpose(1, 2).float()
+    wav_len = sum(audio.shape[-1] for audio in audios) / HUBERT_SAMPLING_RATE
+    LOG.info(
+        f"HuBERT inference time  : {t.elapsed:.3f}s, RTF: {t.elapsed / wav_len:.3f}, "
+        f"batch size: {len(audios)}"
+    )
+    return [c[i : i + 1, :, :c_len] for i, c_len in enumerate(lengths)]
+
+
 def _substitute_if_same_shape(to_: dict[str, Any], from_: dict[str, Any]) -> None:
-    not_in_to = list(filter(lambda x: x not in to_, from_.keys()))
-    not_in_from = list(filter(lambda x: x not in from_, to_.keys()))
+    not_in_to = [k for k in from_ if k not in to_]
+    not_in_from = [k for k in to_ if k not in from_]
     if not_in_to:
         warnings.warn(f"Keys not found in model state dict:" f"{not_in_to}")
     if not_in_from:
         warnings.warn(f"Keys not found in checkpoint state dict:" f"{not_in_from}")
-    shape_missmatch = []
-    for k, v in from_.items():
-        if k not in to_:
-            pass
-        elif hasattr(v, "shape"):
-            if not hasattr(to_[k], "shape"):
-                raise ValueError(f"Key {k} is not a tensor")
-            if to_[k].shape == v.shape:
-                to_[k] = v
-            else:
-                shape_missmatch.append((k, to_[k].shape, v.shape))
-        elif isinstance(v, dict):
-            assert isinstance(to_[k], dict)
-            _substitute_if_same_shape(to_[k], v)
-        else:
-            to_[k] = v
+    shared = [k for k in from_ if k in to_]
+    tensors = [k for k in shared if hasattr(from_[k], "shape")]
+    not_tensor = [k for k in tensors if not hasattr(to_[k], "shape")]
+    if not_tensor:
+        raise ValueError(f"Keys {not_tensor} are not tensors")
+    shape_missmatch = [
+        (k, to_[k].shape, from_[k].shape)
+        for k in tensors
+        if to_[k].shape != from_[k].shape
+    ]
     if shape_missmatch:
         warnings.warn(
             f"Shape mismatch: {[f'{k}: {v1} -> {v2}' for k, v1, v2 in shape_missmatch]}"
         )
+    # nested dicts (optimizer state) are merged recursively
+    nested = [k for k in shared if isinstance(from_[k], dict)]
+    for k in nested:
+        assert isinstance(to_[k], dict)
+        _substitute_if_same_shape(to_[k], from_[k])
+    skip = {k for k, _, _ in shape_missmatch}.union(nested)
+    to_.update({k: from_[k] for k in shared if k not in skip})
 
 
 def safe_load(model: torch.nn.Module, state_dict: dict[str, Any]) -> None:
@@ -290,10 +454,9 @@ def load_checkpoint(
     learning_rate = checkpoint_dict["learning_rate"]
 
     # safe load module
-    if hasattr(model, "module"):
-        safe_load(model.module, checkpoint_dict["model"])
-    else:
-        safe_load(model, checkpoint_dict["model"])
+    safe_load(
+        model.module if hasattr(model, "module") else model, checkpoint_dict["model"]
+    )
     # safe load optim
     if (
         optimizer is not None
@@ -308,13 +471,43 @@ def load_checkpoint(
     return model, optimizer, learning_rate, iteration
 
 
+# a single thread so that checkpoints are written in order
+_CHECKPOINT_EXECUTOR = ThreadPoolExecutor(1, thread_name_prefix="save_checkpoint")
+
+
+def _copy_to_cpu(x: Any) -> Any:
+    # snapshot of the state, which keeps being updated in-place by training
+    if isinstance(x, torch.Tensor):
+        return x.detach().to("cpu", copy=True)
+    if isinstance(x, dict):
+        return {k: _copy_to_cpu(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return type(x)(_copy_to_cpu(v) for v in x)
+    return x
+
+
+def _save_checkpoint(checkpoint: dict[str, Any], checkpoint_path: Path) -> None:
+    # write to a temporary file first so that a partially written checkpoint
+    # is never picked up by latest_checkpoint_path
+    temppath = checkpoint_path.parent / f"{checkpoint_path.name}.tmp"
+    with temppath.open("wb") as f:
+        torch.save(checkpoint, f)
+    temppath.replace(checkpoint_path)
+
+
 def save_checkpoint(
     model: torch.nn.Module,
     optimizer: torch.optim.Optimizer,
     learning_rate: float,
     iteration: int,
     checkpoint_path: Path | str,
-) -> None:
+    background: bool = False,
+) -> Future[None] | None:
+    """Save the checkpoint.
+
+    If `background` is True, the state is copied to the CPU and the returned
+    future writes it to disk on a background thread, so that training can
+    resume immediately."""
     LOG.info(
         "Saving model and optimizer state at epoch {} to {}".format(
             iteration, checkpoint_path
@@ -324,16 +517,29 @@ def save_checkpoint(
         state_dict = model.module.state_dict()
     else:
         state_dict = model.state_dict()
-    with Path(checkpoint_path).open("wb") as f:
-        torch.save(
-            {
-                "model": state_dict,
-                "iteration": iteration,
-                "optimizer": optimizer.state_dict(),
-                "learning_rate": learning_rate,
-            },
-            f,
-        )
+    checkpoint = {
+        "model": state_dict,
+        "iteration": iteration,
+        "optimizer": optimizer.state_dict(),
+        "learning_rate": learning_rate,
+    }
+    if not background:
+        _save_checkpoint(checkpoint, Path(checkpoint_path))
+        return None
+    future = _CHECKPOINT_EXECUTOR.submit(
+        _save_checkpoint, _copy_to_cpu(checkpoint), Path(checkpoint_path)
+    )
+    future.add_done_callback(_log_save_error)
+    return future
+
+
+def _log_save_error(future: Future[None]) -> None:
+    exc = future.exception()
+    if exc is not None:
+        LOG.error("Failed to save checkpoint", exc_info=exc)
+
+
+_CKPT_RE = re.compile(r"([GD])_(\d+)\.pth$")
 
 
 def clean_checkpoints(
@@ -348,30 +554,23 @@ def clean_checkpoints(
                           False -> lexicographically delete ckpts
     """
     LOG.info("Cleaning old checkpoints...")
-    path_to_models = Path(path_to_models)
-
-    # Define sort key functions
-    name_key = lambda p: int(re.match(r"[GD]_(\d+)", p.stem).group(1))
-    time_key = lambda p: p.stat().st_mtime
-    path_key = lambda p: (p.stem[0], time_key(p) if sort_by_time else name_key(p))
-
-    models = list(
-        filter(
-            lambda p: (
-                p.is_file()
-                and re.match(r"[GD]_\d+", p.stem)
-                and not p.stem.endswith("_0")
-            ),
-            path_to_models.glob("*.pth"),
-        )
-    )
 
-    models_sorted = sorted(models, key=path_key)
+    # (group, step, mtime, path) from a single pass over the directory
+    with os.scandir(path_to_models) as it:
+        models = [
+            (m.group(1), int(m.group(2)), entry.stat().st_mtime, Path(entry.path))
+            for entry in it
+            if (m := _CKPT_RE.match(entry.name)) is not None
+            and m.group(2) != "0"
+            and entry.is_file()
+        ]
+
+    models_sorted = sorted(models, key=lambda x: (x[0], x[2] if sort_by_time else x[1]))
 
-    models_sorted_grouped = groupby(models_sorted, lambda p: p.stem[0])
+    models_sorted_grouped = groupby(models_sorted, lambda x: x[0])
 
     for group_name, group_items in models_sorted_grouped:
-        to_delete_list = list(group_items)[:-n_ckpts_to_keep]
+        to_delete_list = [x[3] for x in group_items][:-n_ckpts_to_keep]
 
         for to_delete in to_delete_list:
             if to_delete.exists():
@@ -390,20 +589,30 @@ def latest_checkpoint_path(dir_path: Path | str, regex: str = "G_*.pth") -> Path
     return paths[-1]
 
 
-def plot_spectrogram_to_numpy(spectrogram: ndarray) -> ndarray:
-    matplotlib.use("Agg")
-    fig, ax = plt.subplots(figsize=(10, 2))
-    im = ax.imshow(spectrogram, aspect="auto", origin="lower", interpolation="none")
-    plt.colorbar(im, ax=ax)
-    plt.xlabel("Frames")
-    plt.ylabel("Channels")
-    plt.tight_layout()
+@lru_cache
+def _get_figure() -> Figure:
+    # reused by every plot and drawn with Agg directly, without pyplot
+    fig = Figure(figsize=(10, 2))
+    FigureCanvasAgg(fig)
+    return fig
 
+
+def _figure_to_numpy(fig: Figure) -> ndarray:
+    fig.tight_layout()
     fig.canvas.draw()
-    data = np.fromstring(fig.canvas.tostring_rgb(), dtype=np.uint8, sep="")
-    data = data.reshape(fig.canvas.get_width_height()[::-1] + (3,))
-    plt.close()
-    return data
+    # view of the RGBA buffer of Agg, copied since the figure is reused
+    return np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+
+
+def plot_spectrogram_to_numpy(spectrogram: ndarray) -> ndarray:
+    fig = _get_figure()
+    fig.clear()
+    ax = fig.add_subplot()
+    im = ax.imshow(spectrogram, aspect="auto", origin="lower", interpolation="none")
+    fig.colorbar(im, ax=ax)
+    ax.set_xlabel("Frames")
+    ax.set_ylabel("Channels")
+    return _figure_to_numpy(fig)
 
 
 def get_backup_hparams(
@@ -438,23 +647,60 @@ def repeat_expand_2d(content: torch.Tensor, target_len: int) -> torch.Tensor:
     if target_len < src_len:
         return content[:, :target_len]
     else:
-        return torch.nn.functional.interpolate(
-            content.unsqueeze(0), size=target_len, mode="nearest"
-        ).squeeze(0)
+        # nearest neighbor upsampling as a single gather
+        idx = torch.arange(target_len, device=content.device) * src_len // target_len
+        return content.index_select(1, idx)
 
 
 def plot_data_to_numpy(x: ndarray, y: ndarray) -> ndarray:
-    matplotlib.use("Agg")
-    fig, ax = plt.subplots(figsize=(10, 2))
-    plt.plot(x)
-    plt.plot(y)
-    plt.tight_layout()
+    fig = _get_figure()
+    fig.clear()
+    ax = fig.add_subplot()
+    ax.plot(x)
+    ax.plot(y)
+    return _figure_to_numpy(fig)
+
+
+def load_or_build_index(
+    root: Path | str, rebuild: bool = False
+) -> tuple[ndarray, ndarray]:
+    """List the wav files directly under `root` and the number of frames of their
+    preprocessed `.data.safetensors` (-1 if not preprocessed yet).
+
+    The result is cached in `root/.index.npz` and rebuilt only when `root` was
+    modified (files added, removed or renamed) after the cache was written,
+    or if `rebuild` is True.
+
+    Returns:
+        tuple[ndarray, ndarray]: file names (relative to `root`) and lengths
+    """
+    root = Path(root)
+    index_path = root / INDEX_NAME
+    if not rebuild:
+        try:
+            if index_path.stat().st_mtime >= root.stat().st_mtime:
+                with np.load(index_path) as index:
+                    return index["paths"], index["lengths"]
+        except Exception:
+            # missing or broken, rebuild
+            pass
 
-    fig.canvas.draw()
-    data = np.fromstring(fig.canvas.tostring_rgb(), dtype=np.uint8, sep="")
-    data = data.reshape(fig.canvas.get_width_height()[::-1] + (3,))
-    plt.close()
-    return data
+    # os.scandir does not need to stat each file to tell if it is a file
+    with os.scandir(root) as it:
+        names = {entry.name for entry in it if entry.is_file()}
+    paths = np.array(sorted(name for name in names if name.endswith(".wav")), dtype=str)
+    lengths = np.full(len(paths), -1, dtype=np.int64)
+    for i, name in enumerate(paths.tolist()):
+        if name + ".data.safetensors" in names:
+            with safe_open(
+                root / (name + ".data.safetensors"), framework="pt", device="cpu"
+            ) as f:
+                lengths[i] = f.get_slice("mel_spec").get_shape()[-1]
+    try:
+        np.savez(index_path, paths=paths, lengths=lengths)
+    except OSError as e:
+        LOG.warning(f"Failed to save index to {index_path}: {e}")
+    return paths, lengths
 
 
 def get_gpu_memory(type_: Literal["total", "free", "used"]) -> Sequence[int] | None:
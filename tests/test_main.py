@@ -26,6 +26,107 @@ class TestMain(TestCase):
 
         # infer("tests/dataset_raw/34j/1.wav", "tests/configs/config.json", "tests/logs/44k")
 
+    def test_length_bucket_sampler(self):
+        from random import Random
+
+        from so_vits_svc_fork.dataset import LengthBucketSampler
+
+        random = Random(0)
+        lengths = [random.randint(1, 1000) for _ in range(103)]
+        batch_size, bucket_mult = 4, 5
+        for drop_last in [False, True]:
+            sampler = LengthBucketSampler(
+                range(len(lengths)),
+                batch_size,
+                drop_last,
+                lengths=lengths,
+                bucket_mult=bucket_mult,
+            )
+            batches = list(sampler)
+            self.assertEqual(len(batches), len(sampler))
+            indices = [i for batch in batches for i in batch]
+            self.assertEqual(len(indices), len(set(indices)))
+            if drop_last:
+                self.assertEqual(len(indices), len(lengths) // batch_size * batch_size)
+                self.assertTrue(all(len(batch) == batch_size for batch in batches))
+            else:
+                self.assertEqual(sorted(indices), list(range(len(lengths))))
+            # batches of a pool do not overlap in length
+            for pool_start in range(0, len(batches), bucket_mult):
+                pool = sorted(
+                    batches[pool_start : pool_start + bucket_mult],
+                    key=lambda batch: max(lengths[i] for i in batch),
+                )
+                for shorter, longer in zip(pool, pool[1:]):
+                    self.assertLessEqual(
+                        max(lengths[i] for i in shorter),
+                        min(lengths[i] for i in longer),
+                    )
+
+    def test_packed_data(self):
+        from tempfile import TemporaryDirectory
+
+        import torch
+        from safetensors.torch import save_file
+
+        from so_vits_svc_fork.dataset import PackedData, load_data
+
+        hop_len = 4
+        with TemporaryDirectory() as tempdir:
+            datapaths = []
+            for i, n_frames in enumerate([20, 13]):
+                data = {
+                    "spec": torch.randn(5, n_frames),
+                    "mel_spec": torch.randn(3, n_frames),
+                    "f0": torch.randn(n_frames),
+                    "uv": torch.rand(n_frames).round(),
+                    "content": torch.randn(7, n_frames),
+                    "audio": torch.randn(1, n_frames * hop_len),
+                    "spk": torch.tensor(i).long(),
+                }
+                datapath = Path(tempdir) / f"{i}.wav.data.safetensors"
+                save_file(data, datapath)
+                datapaths.append(datapath)
+                # legacy format
+                torch.save(data, Path(tempdir) / f"{i}.wav.data.pt")
+            packed = PackedData.pack(datapaths, Path(tempdir) / "train.packed")
+            self.assertEqual(packed.spec_lens.tolist(), [20, 13])
+            for i, datapath in enumerate(datapaths):
+                for start, end in [(None, None), (2, 9)]:
+                    expected = load_data(datapath, start, end, hop_len)
+                    legacy = load_data(
+                        Path(tempdir) / f"{i}.wav.data.pt", start, end, hop_len
+                    )
+                    actual = packed.load(i, start, end, hop_len)
+                    self.assertEqual(set(actual), set(expected))
+                    for key in expected:
+                        self.assertTrue(torch.equal(actual[key], expected[key]))
+                        self.assertTrue(torch.equal(legacy[key], expected[key]))
+
+    def test_get_content_batch(self):
+        import torch
+        from transformers import HubertConfig, HubertModel
+
+        from so_vits_svc_fork.utils import get_content, get_content_batch
+
+        # small random model with the same architecture as content-vec
+        config = HubertConfig(
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            intermediate_size=64,
+            conv_dim=(32,) * 7,
+            feat_extract_norm="group",
+        )
+        torch.manual_seed(0)
+        cmodel = HubertModel(config).eval()
+        audios = [torch.randn(16000), torch.randn(9000), torch.randn(12345)]
+        cs = get_content_batch(cmodel, audios, "cpu", 16000)
+        for audio, c in zip(audios, cs):
+            expected = get_content(cmodel, audio, "cpu", 16000)
+            self.assertEqual(c.shape, expected.shape)
+            self.assertTrue(torch.allclose(c, expected, atol=1e-4))
+
     def test_preprocess(self):
         from so_vits_svc_fork.preprocessing.preprocess_resample import (
             preprocess_resample,